@@ -29,15 +29,32 @@ This script outlines the necessary configurations and settings required to use G
 3. Click "Add a lifecycle rule".
 4. Set the rule to delete objects older than 1 day.
 
-Or, to ensure that test uploads are deleted after successful tests, you can modify the test script to delete the test files after successful run.
+The test script also deletes the files it uploads at the end of each run. All test uploads go under the `test/` prefix, and the script adds a 1-day delete rule for that prefix to the bucket's lifecycle configuration (this modifies the bucket settings) as a fallback for runs that are interrupted.
 """
 
+from google.api_core import retry
+from google.api_core.exceptions import GoogleAPIError
+from google.auth.exceptions import GoogleAuthError
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
+try:
+    from google.cloud.storage.exceptions import DataCorruption
+except ImportError:
+    # google-cloud-storage<3.0 raises the google-resumable-media exception
+    from google.resumable_media.common import DataCorruption
+import google_crc32c
+from requests.adapters import HTTPAdapter
+import inspect
 import os
+import shutil
+from functools import lru_cache
+import subprocess
 from dotenv import load_dotenv
 import logging
-import datetime
+import time
 import uuid
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # Set up logging
@@ -47,142 +64,354 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+# Read the bucket name once; it is validated when the bucket is first used
+_BUCKET_NAME = os.environ.get('GCP_BUCKET_NAME')
+
+# Retry transient errors (5xx, dropped connections) with exponential backoff
+_RETRY = retry.Retry(initial=1.0, maximum=16.0, multiplier=2.0, deadline=120.0)
+# Cached result of the bucket existence probe, so it is only issued once
+_BUCKET_OK = False
+
 # Define paths using pathlib for cross-platform compatibility
 BASE_DIR = Path(__file__).resolve().parent.parent
 ASSETS_DIR = BASE_DIR / "assets"
 CACHE_DIR = ASSETS_DIR / "__pycache__"
 DOWNLOADS_DIR = ASSETS_DIR / "downloads"
 
-def get_public_url(bucket_name, blob_name):
-    """Generate public URL for a blob"""
-    return f"https://storage.googleapis.com/{bucket_name}/{blob_name}"
+# Objects above these sizes are transferred in parallel slices, using threads
+# so the shared client (and its connection pool) is reused by every worker
+CONCURRENT_TRANSFER_LIMIT = 32 * 1024 * 1024
+CONCURRENT_CHUNK_SIZE = 32 * 1024 * 1024
+CONCURRENT_DOWNLOAD_LIMIT = 200 * 1024 * 1024
+CONCURRENT_DOWNLOAD_CHUNK_SIZE = 64 * 1024 * 1024
+CONCURRENT_MAX_WORKERS = 8
+# single_shot_download is only accepted by google-cloud-storage>=3.2.0
+SUPPORTS_SINGLE_SHOT_DOWNLOAD = (
+    "single_shot_download" in inspect.signature(storage.Blob.download_to_filename).parameters
+)
+# Objects above this size are handed to the gcloud CLI when it is installed
+GCLOUD_TRANSFER_LIMIT = 64 * 1024 * 1024
+GCLOUD_TIMEOUT = 600
+# Prefix for throwaway test objects, covered by a 1-day lifecycle rule
+TEST_PREFIX = "test/"
+# Extended attribute used to remember the etag of a downloaded object
+ETAG_XATTR = "user.gcs.etag"
+
+# Generate public URL for a blob; the bucket prefix is fixed for the run
+_URL_PREFIX = f"https://storage.googleapis.com/{_BUCKET_NAME}/"
+get_public_url = _URL_PREFIX.__add__
+
+@lru_cache(maxsize=1)
+def _get_bucket():
+    """Return the shared bucket, creating the storage client on first use
+
+    The client is built lazily so importing this module (e.g. during test
+    discovery) does not require GCP credentials. It is reused across tests so
+    the authorized session and its HTTPS keep-alive connections are only set
+    up once per run.
+    """
+    if not _BUCKET_NAME:
+        raise RuntimeError("GCP_BUCKET_NAME is not set. Please add it to your .env file or environment variables.")
+    client = storage.Client()
+    # Enlarge the HTTPS connection pool (default 10) so concurrent blob
+    # operations don't block waiting for a free connection
+    client._http.mount(
+        "https://",
+        HTTPAdapter(pool_connections=100, pool_maxsize=100, pool_block=False),
+    )
+    return client.bucket(_BUCKET_NAME)
+
+def read_cached_etag(path):
+    """Read the etag stored alongside a downloaded file, if any"""
+    try:
+        return os.getxattr(path, ETAG_XATTR).decode()
+    except (AttributeError, OSError):
+        # No xattr support (e.g. macOS/Windows or tmpfs): use a sidecar file
+        etag_path = path.with_name(path.name + ".etag")
+        if etag_path.is_file():
+            return etag_path.read_text()
+        return None
+
+def write_cached_etag(path, etag):
+    """Store the etag of a downloaded file for later comparison"""
+    try:
+        os.setxattr(path, ETAG_XATTR, etag.encode())
+    except (AttributeError, OSError):
+        path.with_name(path.name + ".etag").write_text(etag)
+
+def gcloud_cp(source, destination):
+    """Copy an object with `gcloud storage cp`
+
+    gcloud ignores Application Default Credentials, so the service account key
+    in GOOGLE_APPLICATION_CREDENTIALS is passed through to run as the same
+    identity as the storage client. Without it, gcloud uses its own active
+    account.
+    """
+    env = os.environ.copy()
+    credentials_file = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+    if credentials_file:
+        env["CLOUDSDK_AUTH_CREDENTIAL_FILE_OVERRIDE"] = credentials_file
+    try:
+        subprocess.run(
+            ["gcloud", "storage", "cp", source, destination],
+            check=True,
+            capture_output=True,
+            text=True,
+            timeout=GCLOUD_TIMEOUT,
+            env=env,
+        )
+    except subprocess.CalledProcessError as e:
+        logger.error(f"gcloud storage cp failed: {e.stderr.strip()}")
+        raise
+
+def ensure_lifecycle_rule():
+    """Ensure test uploads are deleted by the bucket after one day
+
+    Note: this patches the bucket's lifecycle configuration, adding a delete
+    rule scoped to TEST_PREFIX if an equivalent rule is not already present.
+    """
+    try:
+        bucket = _get_bucket()
+        bucket.reload(retry=_RETRY)
+        for rule in bucket.lifecycle_rules:
+            condition = rule.get("condition", {})
+            if (rule.get("action", {}).get("type") == "Delete"
+                    and condition.get("age") == 1
+                    and condition.get("matchesPrefix") == [TEST_PREFIX]):
+                return True
+        bucket.add_lifecycle_delete_rule(age=1, matches_prefix=[TEST_PREFIX])
+        bucket.patch(retry=_RETRY)
+        logger.info(f"Added 1-day lifecycle delete rule for: {TEST_PREFIX}")
+        return True
+    except (GoogleAPIError, GoogleAuthError) as e:
+        logger.warning(f"Failed to set lifecycle rule on bucket: {str(e)}")
+        return False
+
+def check_crc32c():
+    """Warn if CRC32C checksums are computed in pure Python"""
+    if google_crc32c.implementation != "c":
+        logger.warning(
+            "google-crc32c is using its pure-Python fallback, which makes checksum "
+            "validation on uploads and downloads very slow. Reinstall google-crc32c "
+            "with its C extension (pip install --force-reinstall google-crc32c)."
+        )
+        return False
+    return True
 
 def ensure_directories():
     """Ensure all required directories exist"""
-    for directory in [ASSETS_DIR, CACHE_DIR, DOWNLOADS_DIR]:
-        directory.mkdir(parents=True, exist_ok=True)
-        logger.info(f"Directory ensured: {directory}")
+    # ASSETS_DIR is created implicitly as the parent of both leaf directories
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    DOWNLOADS_DIR.mkdir(parents=True, exist_ok=True)
+    logger.info(f"Directories ensured: {CACHE_DIR}, {DOWNLOADS_DIR}")
     return True
 
 def test_gcp_connection():
     """Test basic connection to GCP bucket"""
+    global _BUCKET_OK
+    if _BUCKET_OK:
+        return True
     try:
-        storage_client = storage.Client()
-        bucket_name = os.getenv('GCP_BUCKET_NAME')
-        bucket = storage_client.bucket(bucket_name)
-        
-        if bucket.exists():
-            logger.info(f"Successfully connected to bucket: {bucket_name}")
+        _BUCKET_OK = _get_bucket().exists(retry=_RETRY)
+        if _BUCKET_OK:
+            logger.info(f"Successfully connected to bucket: {_BUCKET_NAME}")
             return True
         else:
-            logger.error(f"Bucket {bucket_name} does not exist")
+            logger.error(f"Bucket {_BUCKET_NAME} does not exist")
             return False
-    except Exception as e:
+    except (GoogleAPIError, GoogleAuthError, DataCorruption, OSError) as e:
         logger.error(f"Failed to connect to GCP bucket: {str(e)}")
         return False
+    except Exception as e:
+        logger.exception(f"Unexpected error, failed to connect to GCP bucket: {str(e)}")
+        return False
 
 def test_write_operation():
     """Test writing a test file to the bucket"""
+    if not test_gcp_connection():
+        return None
     try:
-        storage_client = storage.Client()
-        bucket_name = os.getenv('GCP_BUCKET_NAME')
-        bucket = storage_client.bucket(bucket_name)
-        
         # Create a test file with timestamp
-        test_content = f"Test content generated at {datetime.datetime.now()}"
-        test_file_name = f"test_file_{uuid.uuid4()}.txt"
+        test_content = f"Test content generated at {time.time_ns()}"
+        test_file_name = f"test_file_{uuid.uuid4().hex}.txt"
         
-        # Create local test file first
-        test_file_path = ASSETS_DIR / test_file_name
-        with open(test_file_path, 'w') as f:
-            f.write(test_content)
+        # Upload the test content straight from memory
+        blob_name = f"{TEST_PREFIX}{test_file_name}"
+        blob = _get_bucket().blob(blob_name)
+        blob.upload_from_string(test_content.encode(), content_type='text/plain', retry=_RETRY)
         
-        # Upload the test file
-        blob_name = f"test/{test_file_name}"
-        blob = bucket.blob(blob_name)
-        blob.upload_from_filename(str(test_file_path))
-        
-        public_url = get_public_url(bucket_name, blob_name)
+        public_url = get_public_url(blob_name)
         logger.info(f"Successfully wrote test file: {test_file_name}")
         logger.info(f"Public URL: {public_url}")
         return blob_name
-    except Exception as e:
+    except (GoogleAPIError, GoogleAuthError, DataCorruption, OSError) as e:
         logger.error(f"Failed to write to bucket: {str(e)}")
         return None
+    except Exception as e:
+        logger.exception(f"Unexpected error, failed to write to bucket: {str(e)}")
+        return None
 
 def test_image_upload():
     """Test uploading an image file from assets"""
+    if not test_gcp_connection():
+        return None
     try:
-        storage_client = storage.Client()
-        bucket_name = os.getenv('GCP_BUCKET_NAME')
-        bucket = storage_client.bucket(bucket_name)
-        
         # Use specific image file
         test_image = "CyberSOAR  Logo-13.png"
         image_path = CACHE_DIR / test_image
         
-        if not image_path.exists():
+        if not image_path.is_file():
             logger.error(f"Image file not found at: {image_path}")
-            logger.info(f"Available files in cache dir: {list(CACHE_DIR.glob('*'))}")
+            cache_sample = list(islice(CACHE_DIR.iterdir(), 20)) if CACHE_DIR.is_dir() else []
+            logger.info(f"Sample files in cache dir: {cache_sample}")
             return None
             
-        # Upload to a designs folder to simulate design generator output
-        blob_name = f"designs/{test_image}"
-        blob = bucket.blob(blob_name)
-        blob.upload_from_filename(str(image_path))
+        # Upload to a designs folder to simulate design generator output,
+        # kept under the test prefix so the lifecycle rule covers it
+        blob_name = f"{TEST_PREFIX}designs/{test_image}"
+        blob = _get_bucket().blob(blob_name)
+        image_size = image_path.stat().st_size
+        if image_size > GCLOUD_TRANSFER_LIMIT and shutil.which("gcloud"):
+            gcloud_cp(str(image_path), f"gs://{_BUCKET_NAME}/{blob_name}")
+        elif image_size > CONCURRENT_TRANSFER_LIMIT:
+            transfer_manager.upload_chunks_concurrently(
+                str(image_path),
+                blob,
+                chunk_size=CONCURRENT_CHUNK_SIZE,
+                worker_type=transfer_manager.THREAD,
+                max_workers=CONCURRENT_MAX_WORKERS,
+                retry=_RETRY,
+            )
+        else:
+            # The client already uploads up to 8 MiB in one request and uses
+            # 100 MiB resumable chunks above that
+            blob.upload_from_filename(str(image_path), retry=_RETRY)
         
-        public_url = get_public_url(bucket_name, blob_name)
+        public_url = get_public_url(blob_name)
         logger.info(f"Successfully uploaded image: {test_image}")
         logger.info(f"Public URL: {public_url}")
         return blob_name
-    except Exception as e:
+    except (GoogleAPIError, GoogleAuthError, DataCorruption, OSError, subprocess.SubprocessError) as e:
         logger.error(f"Failed to upload image: {str(e)}")
         return None
+    except Exception as e:
+        logger.exception(f"Unexpected error, failed to upload image: {str(e)}")
+        return None
 
-def test_image_download(blob_name):
-    """Test downloading an image file"""
+def test_image_download(blob_name, skip_if_unchanged=True):
+    """Test downloading an image file
+
+    With skip_if_unchanged, the download is skipped when the local copy's
+    stored etag matches the remote object. This only helps standalone calls:
+    in run_all_tests the object is always freshly uploaded, so the check is
+    disabled there.
+    """
+    if not test_gcp_connection():
+        return None
     try:
-        storage_client = storage.Client()
-        bucket_name = os.getenv('GCP_BUCKET_NAME')
-        bucket = storage_client.bucket(bucket_name)
-        
-        blob = bucket.blob(blob_name)
+        blob = _get_bucket().blob(blob_name)
         download_path = DOWNLOADS_DIR / os.path.basename(blob_name)
-        blob.download_to_filename(str(download_path))
+        blob.reload(retry=_RETRY)
+        
+        # Skip the download if the local copy matches the remote object
+        if (skip_if_unchanged and download_path.is_file()
+                and read_cached_etag(download_path) == blob.etag):
+            logger.info(f"Local copy is up to date, skipping download: {download_path}")
+            return str(download_path)
+        
+        if blob.size > GCLOUD_TRANSFER_LIMIT and shutil.which("gcloud"):
+            gcloud_cp(f"gs://{_BUCKET_NAME}/{blob_name}#{blob.generation}", str(download_path))
+        elif blob.size > CONCURRENT_DOWNLOAD_LIMIT:
+            transfer_manager.download_chunks_concurrently(
+                blob,
+                str(download_path),
+                chunk_size=CONCURRENT_DOWNLOAD_CHUNK_SIZE,
+                download_kwargs={
+                    "if_generation_match": blob.generation,
+                    "raw_download": True,
+                    "retry": _RETRY,
+                },
+                worker_type=transfer_manager.THREAD,
+                max_workers=CONCURRENT_MAX_WORKERS,
+            )
+        else:
+            # Fetch the object in one request (where supported) and keep any
+            # gzip encoding as stored
+            download_kwargs = {"single_shot_download": True} if SUPPORTS_SINGLE_SHOT_DOWNLOAD else {}
+            blob.download_to_filename(
+                str(download_path),
+                if_generation_match=blob.generation,
+                raw_download=True,
+                timeout=120,
+                retry=_RETRY,
+                **download_kwargs,
+            )
+        if skip_if_unchanged:
+            write_cached_etag(download_path, blob.etag)
         
-        public_url = get_public_url(bucket_name, blob_name)
+        public_url = get_public_url(blob_name)
         logger.info(f"Successfully downloaded image to: {download_path}")
         logger.info(f"Public URL: {public_url}")
         return str(download_path)
-    except Exception as e:
+    except (GoogleAPIError, GoogleAuthError, DataCorruption, OSError, subprocess.SubprocessError) as e:
         logger.error(f"Failed to download image: {str(e)}")
         return None
+    except Exception as e:
+        logger.exception(f"Unexpected error, failed to download image: {str(e)}")
+        return None
 
 def run_all_tests():
-    """Run all tests in sequence"""
+    """Run all tests, overlapping the independent upload steps"""
     logger.info("Starting GCP Storage tests...")
     
-    # Ensure directories exist
+    # Ensure directories exist and checksums use the fast implementation
     ensure_directories()
+    check_crc32c()
     
     # Test 1: Connection
     if not test_gcp_connection():
         logger.error("Connection test failed. Stopping further tests.")
         return
     
-    # Test 2: Write Operation
-    test_file = test_write_operation()
-    if not test_file:
-        logger.error("Write operation failed. Stopping further tests.")
-        return
-    
-    # Test 3: Image Upload
-    image_blob_name = test_image_upload()
-    if image_blob_name:
-        # Test 4: Image Download
-        downloaded_path = test_image_download(image_blob_name)
-        if downloaded_path:
-            logger.info(f"Image download test successful: {downloaded_path}")
+    created = []
+    try:
+        ensure_lifecycle_rule()
+        
+        # Test 2 and 3: Write Operation and Image Upload are independent, so run them concurrently
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(test_write_operation), executor.submit(test_image_upload)]
+        # Collect every result before anything can raise, so cleanup sees all uploads
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.exception(f"Upload test raised an error: {str(e)}")
+                results.append(None)
+        test_file, image_blob_name = results
+        created.extend(name for name in results if name)
+        
+        if not test_file:
+            logger.error("Write operation failed. Stopping further tests.")
+            return
+        
+        if image_blob_name:
+            # Test 4: Image Download
+            downloaded_path = test_image_download(image_blob_name, skip_if_unchanged=False)
+            if downloaded_path:
+                logger.info(f"Image download test successful: {downloaded_path}")
+    finally:
+        # Clean up uploaded test objects so they don't accumulate in the bucket
+        if created:
+            try:
+                _get_bucket().delete_blobs(
+                    created,
+                    on_error=lambda name: logger.warning(f"Test object already deleted: {name}"),
+                    retry=_RETRY,
+                )
+                logger.info(f"Deleted test objects: {created}")
+            except (GoogleAPIError, GoogleAuthError) as e:
+                logger.warning(f"Failed to delete test objects {created}: {str(e)}")
     
     logger.info("All tests completed.")
 
@@ -39,6 +39,7 @@ class ChatWizardAgent(Agent):
 """
 
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 from openai import OpenAI
 
@@ -50,6 +51,12 @@ load_dotenv()
 OPENAI_MODEL_NAME=gpt-4o-mini-2024-07-18
 """
 
+@lru_cache(maxsize=1)
+def _get_models(api_key):
+    # Initialize the client once and cache the model IDs for the process
+    client = OpenAI(api_key=api_key, timeout=10)
+    return tuple(model.id for model in client.models.list().data)
+
 def list_models():
     # Get API key from environment
     api_key = os.getenv("OPENAI_API_KEY")
@@ -59,16 +66,12 @@ def list_models():
         return
     
     try:
-        # Initialize the client
-        client = OpenAI(api_key=api_key)
-        
         # List available models
-        models = client.models.list()
+        model_ids = _get_models(api_key)
         
         print("\nAvailable models for your API key:")
         print("----------------------------------")
-        for model in models.data:
-            print(f"- {model.id}")
+        print("\n".join(f"- {model_id}" for model_id in model_ids))
             
     except Exception as e:
         print(f"\nError accessing OpenAI API: {str(e)}")